@@ -8,7 +8,13 @@
 # 3. Decrypts and displays the payload
 # 4. Publishes encrypted commands to control LED on ESP32
 # 
+# Payload format (must match TAB5-MQTT-Crypto-Complete.ino):
+#   [IV (16B)][AES-128-CBC ciphertext, PKCS#7][HMAC-SHA256 (32B)]
+# The ESP32 firmware speaks only this format, so a switch to another
+# scheme (e.g. AES-GCM) has to be made on both sides at once.
+# 
 # Requirements: pip install paho-mqtt pycryptodome
+#               (optional: msgspec, for faster LED command parsing)
 # 
 # Usage: python3 mqtt_test_client.py <broker_ip> <ca_cert_path>
 # ============================================================================
@@ -17,17 +23,49 @@ import paho.mqtt.client as mqtt
 import os
 import sys
 import json
+import asyncio
+import logging
 import time
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+import hashlib
+import hmac as _hmac
 from Crypto.Cipher import AES
-from Crypto.Hash import HMAC, SHA256
-import binascii
+
+try:
+    # pycryptodome only uses AES-NI if the CPU supports it; otherwise it
+    # silently falls back to table-based AES. Detect it so we can say so.
+    from Crypto.Util._cpu_features import have_aes_ni
+    AES_NI_AVAILABLE = bool(have_aes_ni())
+except ImportError:
+    AES_NI_AVAILABLE = False
+
+try:
+    # Optional: msgspec parses and validates LED commands in C, straight
+    # from the decrypted bytes into a typed struct
+    import msgspec
+except ImportError:
+    msgspec = None
 
 # Configuration
 MQTT_BROKER = "192.168.1.100"  # Change to your broker IP
 MQTT_PORT = 8883
 MQTT_USER = "esp32_client"
 MQTT_PASSWORD = "password123"
+MQTT_CLIENT_ID = "mqtt_test_client_stable"  # Fixed ID for the persistent session
 CA_CERT = "ca.crt"
+LOG_LEVEL = logging.INFO  # logging.DEBUG shows per-message details
+DECRYPT_WORKERS = 2  # Threads verifying/decrypting received messages
+DECRYPT_BATCH_SIZE = 32  # Max queued messages decrypted in one AES call
+REPLAY_CACHE_SIZE = 1024  # Recently seen HMAC tags kept to drop duplicates
+# Seconds a command may lag both the newest one from its device and our own
+# clock. The per-device floor only grows while the client runs: if a device's
+# clock steps back further than this (RTC reset before NTP sync, the NTP
+# fallback date), restart the client to accept its commands again.
+REPLAY_WINDOW = 300
+
+log = logging.getLogger("mqttclient")
 
 # Cryptographic keys (MUST match ESP32)
 AES_KEY = bytes([
@@ -39,6 +77,253 @@ HMAC_KEY = bytes([
     0x0b] * 32
 )
 
+# ============================================================================
+# Crypto Helpers
+# ============================================================================
+
+# HMAC-SHA256 keyed once: the ipad/opad key blocks are hashed here, and each
+# message works on a copy() instead of re-deriving them from HMAC_KEY. This
+# is the stdlib hmac on purpose: its copy() clones both SHA-256 states in C,
+# whereas pycryptodome's HMAC.copy() re-runs the whole key derivation.
+_HMAC_TEMPLATE = _hmac.new(HMAC_KEY, digestmod=hashlib.sha256)
+
+# Single ECB cipher shared by all decryptions. CBC decryption is rebuilt on
+# top of it (P[i] = D(C[i]) XOR C[i-1]), so the cipher object and its key
+# schedule are created once instead of once per message.
+_AES_ECB = AES.new(AES_KEY, AES.MODE_ECB, use_aesni=True)
+
+def cbc_decrypt_batch(frames):
+    """Decrypt several AES-128-CBC (iv, ciphertext) frames in one AES call.
+
+    The ciphertexts are concatenated and run through a single ECB decrypt,
+    then XORed in one pass with the CBC chaining values of every frame (its
+    IV followed by all but its last ciphertext block). Returns the padded
+    plaintexts in order.
+    """
+    decrypted = _AES_ECB.decrypt(b"".join(ciphertext for _, ciphertext in frames))
+    chain = b"".join(part for iv, ciphertext in frames for part in (iv, ciphertext[:-16]))
+    
+    # Whole-buffer XOR as one big integer: runs in C over the entire batch
+    # instead of one interpreter round-trip per 16-byte block
+    size = len(decrypted)
+    plaintext = (int.from_bytes(decrypted, "big") ^
+                 int.from_bytes(chain, "big")).to_bytes(size, "big")
+    
+    plaintexts = []
+    offset = 0
+    for _, ciphertext in frames:
+        plaintexts.append(plaintext[offset:offset + len(ciphertext)])
+        offset += len(ciphertext)
+    
+    return plaintexts
+
+# PKCS#7 check tables, indexed by the pad byte n: _PAD_MASKS[n] selects the
+# last n bytes of a block and _PAD_FILLS[n] holds the value n in each of them
+_PAD_MASKS = [(1 << (8 * min(n, 16))) - 1 for n in range(256)]
+_PAD_FILLS = [int.from_bytes(bytes([n]) * min(n, 16), "big") for n in range(256)]
+
+def pkcs7_unpad(padded):
+    """Remove PKCS#7 padding, or return None if the padding is invalid.
+
+    The last block is checked as a single 128-bit integer: every padding
+    byte is compared at once by masked XOR, with no per-byte loop and no
+    branch on the (secret) padding value until the final verdict.
+    """
+    pad = padded[-1]
+    last_block = int.from_bytes(padded[-16:], "big")
+    # Non-zero when pad == 0, pad > 16 or any padding byte differs from pad
+    acc = (((pad - 1) >> 8) | ((16 - pad) >> 8) |
+           ((last_block ^ _PAD_FILLS[pad]) & _PAD_MASKS[pad]))
+    
+    if acc != 0:
+        return None
+    return padded[:-pad]
+
+# ============================================================================
+# Message Processing
+# ============================================================================
+
+# Raw (topic, payload) pairs handed over by on_message
+_message_queue = queue.SimpleQueue()
+
+# Replay protection: first 8 bytes of recently accepted HMAC tags (oldest
+# first) and the newest command timestamp seen from each device
+_seen_tags = OrderedDict()
+_last_timestamps = {}
+_replay_lock = threading.Lock()
+
+if msgspec is not None:
+    class LedCommand(msgspec.Struct):
+        """LED command sent by the ESP32 and by this client"""
+        device: str
+        brightness: int
+        timestamp: int
+    
+    parse_led_command = msgspec.json.Decoder(LedCommand).decode
+    LED_COMMAND_ERRORS = (msgspec.DecodeError,)
+else:
+    LedCommand = namedtuple("LedCommand", "device brightness timestamp")
+    
+    def parse_led_command(plaintext):
+        """Parse a decrypted JSON LED command"""
+        data = json.loads(plaintext)
+        command = LedCommand(data["device"], data["brightness"], data["timestamp"])
+        
+        # Same schema as the msgspec struct (which also rejects bools as ints)
+        if not isinstance(command.device, str):
+            raise TypeError("device must be a string")
+        for name in ("brightness", "timestamp"):
+            value = getattr(command, name)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise TypeError(f"{name} must be an integer")
+        return command
+    
+    # JSONDecodeError and UnicodeDecodeError are ValueErrors
+    LED_COMMAND_ERRORS = (ValueError, KeyError, TypeError)
+
+def verify_message(topic, payload):
+    """Verify the HMAC of a message, returning its (iv, ciphertext) or None"""
+    log.debug("Received encrypted message on topic: %s (%d bytes)", topic, len(payload))
+    
+    # Zero-copy view: the slices below do not allocate new bytes objects
+    payload = memoryview(payload)
+    
+    # Step 1: Extract HMAC (last 32 bytes)
+    received_hmac = payload[-32:]
+    encrypted_data = payload[:-32]
+    
+    # Redelivered (QoS 1) or replayed message: skip all crypto work.
+    # Otherwise reserve the tag in the same lock section, so another worker
+    # holding a copy of this message drops it instead of accepting it too.
+    # The lookup runs before the HMAC check, so a tampered copy of an
+    # already accepted message is dropped here as a duplicate (DEBUG)
+    # rather than reported as an HMAC failure.
+    tag_key = bytes(received_hmac[:8])
+    with _replay_lock:
+        if tag_key in _seen_tags:
+            _seen_tags.move_to_end(tag_key)
+            log.debug("Duplicate message on %s ignored", topic)
+            return None
+        _seen_tags[tag_key] = None
+    
+    # Step 2: Compute HMAC-SHA256
+    hmac_obj = _HMAC_TEMPLATE.copy()
+    hmac_obj.update(encrypted_data)
+    computed_hmac = hmac_obj.digest()
+    
+    # Constant-time comparison
+    if not _hmac.compare_digest(computed_hmac, received_hmac):
+        # Release the reservation: forged tags must not stay in the cache
+        with _replay_lock:
+            _seen_tags.pop(tag_key, None)
+        log.warning("✗ HMAC verification FAILED on %s (tampering detected!)", topic)
+        log.warning("  Expected: %s", computed_hmac.hex())
+        log.warning("  Received: %s", received_hmac.hex())
+        return None
+    
+    # Evict only once verified, so forged tags cannot push real ones out
+    with _replay_lock:
+        while len(_seen_tags) > REPLAY_CACHE_SIZE:
+            _seen_tags.popitem(last=False)
+    
+    # Step 3: Extract IV and ciphertext
+    iv = encrypted_data[:16]
+    ciphertext = encrypted_data[16:]
+    
+    log.debug("✓ HMAC verification passed, ciphertext: %d bytes", len(ciphertext))
+    
+    return iv, ciphertext
+
+def handle_plaintext(topic, plaintext_padded):
+    """Unpad, parse and display one decrypted message"""
+    # Step 5: Remove PKCS#7 padding
+    plaintext = pkcs7_unpad(plaintext_padded)
+    if plaintext is None:
+        log.warning("✗ Invalid padding in message on %s", topic)
+        return
+    
+    # Parse JSON (directly from bytes, no intermediate str)
+    try:
+        command = parse_led_command(plaintext)
+    except LED_COMMAND_ERRORS as e:
+        log.warning("✗ Not a valid LED command on %s: %s", topic, e)
+        return
+    
+    # A command much older than the newest one seen from its device is a
+    # replay of a captured message. The window (rather than a strict floor)
+    # keeps the check independent of the order in which workers finish, and
+    # the wall-clock bound stops a device clock that once ran ahead from
+    # locking out its later, correct timestamps.
+    oldest_fresh = time.time() - REPLAY_WINDOW
+    with _replay_lock:
+        newest = _last_timestamps.get(command.device, command.timestamp)
+        replayed = (command.timestamp < newest - REPLAY_WINDOW and
+                    command.timestamp < oldest_fresh)
+        if not replayed:
+            _last_timestamps[command.device] = max(newest, command.timestamp)
+    
+    if replayed:
+        log.warning("✗ Replayed command from %s ignored (timestamp %d, newest %d)",
+                    command.device, command.timestamp, newest)
+        return
+    
+    # The command was parsed straight from bytes; decode to text only
+    # when the line is actually going to be logged
+    if log.isEnabledFor(logging.INFO):
+        log.info("✓ Decrypted message on %s: %s", topic, plaintext.decode('utf-8'))
+    log.debug("  Parsed: %r", command)
+
+def process_messages(messages):
+    """Verify, decrypt and display a batch of (topic, payload) messages"""
+    # Failures are isolated per message: one bad message must not take the
+    # rest of its batch down with it
+    topics = []
+    frames = []
+    for topic, payload in messages:
+        try:
+            frame = verify_message(topic, payload)
+        except Exception:
+            log.exception("✗ Error verifying message on %s", topic)
+            continue
+        if frame is not None:
+            topics.append(topic)
+            frames.append(frame)
+    
+    if not frames:
+        return
+    
+    # Step 4: Decrypt all verified messages with a single AES call
+    try:
+        plaintexts = cbc_decrypt_batch(frames)
+    except Exception:
+        log.exception("✗ Error decrypting %d message(s)", len(frames))
+        return
+    
+    for topic, plaintext_padded in zip(topics, plaintexts):
+        try:
+            handle_plaintext(topic, plaintext_padded)
+        except Exception:
+            log.exception("✗ Error processing message on %s", topic)
+
+def decrypt_worker():
+    """Worker thread: drain the queue and process up to DECRYPT_BATCH_SIZE messages at a time"""
+    while True:
+        messages = [_message_queue.get()]
+        while len(messages) < DECRYPT_BATCH_SIZE:
+            try:
+                messages.append(_message_queue.get_nowait())
+            except queue.Empty:
+                break
+        process_messages(messages)
+
+def start_decrypt_workers():
+    """Start the decrypt worker threads"""
+    # pycryptodome releases the GIL inside AES, so several workers
+    # can decrypt in parallel on multi-core gateways
+    for i in range(DECRYPT_WORKERS):
+        worker = threading.Thread(target=decrypt_worker, name=f"decrypt-{i}", daemon=True)
+        worker.start()
+
 # ============================================================================
 # MQTT Callbacks
 # ============================================================================
@@ -46,92 +331,125 @@ HMAC_KEY = bytes([
 def on_connect(client, userdata, flags, rc):
     """Callback when connected to broker"""
     if rc == 0:
-        print("✓ Connected to MQTT broker!")
-        print(f"  Broker: {MQTT_BROKER}:{MQTT_PORT}")
-        print(f"  User: {MQTT_USER}")
+        log.info("✓ Connected to MQTT broker %s:%d as %s", MQTT_BROKER, MQTT_PORT, MQTT_USER)
+        
+        # Persistent session: the broker kept our subscription (and queued
+        # QoS 1 messages) while we were away, so there is nothing to redo
+        if flags.get("session present"):
+            log.info("✓ Resumed session, still subscribed to: led/control/encrypted")
+            return
         
         # Subscribe to encrypted LED control topic
-        client.subscribe("led/control/encrypted")
-        print("✓ Subscribed to: led/control/encrypted")
+        client.subscribe("led/control/encrypted", qos=1)
+        log.info("✓ Subscribed to: led/control/encrypted")
     else:
-        print(f"✗ Connection failed with code {rc}")
+        log.error("✗ Connection failed with code %s", rc)
 
 def on_disconnect(client, userdata, rc):
     """Callback when disconnected from broker"""
     if rc != 0:
-        print(f"✗ Unexpected disconnection: {rc}")
+        log.warning("✗ Unexpected disconnection: %s", rc)
     else:
-        print("✓ Disconnected from broker")
+        log.info("✓ Disconnected from broker")
 
 def on_message(client, userdata, msg):
-    """Callback when message received"""
-    print(f"\n{'='*60}")
-    print(f"Received encrypted message on topic: {msg.topic}")
-    print(f"Payload length: {len(msg.payload)} bytes")
+    """Callback when message received - hands it over to the decrypt workers"""
+    # Runs on the event loop that drives the socket: no crypto here, so
+    # keepalives and acknowledgements are never delayed by decryption
     
-    try:
-        payload = msg.payload
-        
-        # Step 1: Extract HMAC (last 32 bytes)
-        received_hmac = payload[-32:]
-        encrypted_data = payload[:-32]
-        
-        print(f"\nVerifying HMAC...")
-        print(f"  Encrypted data length: {len(encrypted_data)} bytes")
-        print(f"  HMAC length: {len(received_hmac)} bytes")
-        
-        # Step 2: Compute HMAC-SHA256
-        hmac_obj = HMAC.new(HMAC_KEY, msg=encrypted_data, digestmod=SHA256)
-        computed_hmac = hmac_obj.digest()
-        
-        # Constant-time comparison
-        if computed_hmac == received_hmac:
-            print(f"✓ HMAC verification: PASSED")
-        else:
-            print(f"✗ HMAC verification: FAILED (tampering detected!)")
-            print(f"  Expected: {binascii.hexlify(computed_hmac).decode()}")
-            print(f"  Received: {binascii.hexlify(received_hmac).decode()}")
-            return
-        
-        # Step 3: Extract IV and ciphertext
-        iv = encrypted_data[:16]
-        ciphertext = encrypted_data[16:]
-        
-        print(f"\nDecrypting AES-128-CBC...")
-        print(f"  IV: {binascii.hexlify(iv).decode()}")
-        print(f"  Ciphertext length: {len(ciphertext)} bytes")
-        
-        # Step 4: Decrypt with AES-128-CBC
-        cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
-        plaintext_padded = cipher.decrypt(ciphertext)
+    # Reject malformed frames before any crypto: at least IV (16B) + one
+    # ciphertext block (16B) + HMAC (32B), in whole AES blocks
+    length = len(msg.payload)
+    if length < 64 or (length - 48) % 16 != 0:
+        log.warning("✗ Malformed message on %s (%d bytes), ignored", msg.topic, length)
+        return
+    
+    _message_queue.put_nowait((msg.topic, msg.payload))
+
+# ============================================================================
+# Network Loop
+# ============================================================================
+
+class AsyncioNetworkLoop:
+    """Drive a paho client's socket from an asyncio event loop.
+
+    Replaces loop_forever()/loop_start(): paho reads and writes only when the
+    event loop reports the socket ready, so received messages are dispatched
+    on the loop thread without a separate network thread.
+    """
+    
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.stopping = asyncio.Event()
+        self.closed = asyncio.Event()
+        self._misc_task = None
         
-        # Step 5: Remove PKCS#7 padding
-        padding_len = plaintext_padded[-1]
-        if padding_len > 16 or padding_len == 0:
-            print(f"✗ Invalid padding length: {padding_len}")
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+    
+    def on_socket_open(self, client, userdata, sock):
+        self.closed.clear()
+        self.loop.add_reader(sock, self._read, sock)
+        self._misc_task = self.loop.create_task(self._misc_loop())
+    
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+        self.closed.set()
+    
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+    
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+    
+    def _read(self, sock):
+        # TLS records already decrypted into the SSL buffer are invisible to
+        # select(), so drain them now rather than waiting for the next packet
+        pending = getattr(sock, "pending", None)
+        while self.client.loop_read() == mqtt.MQTT_ERR_SUCCESS and pending and pending():
+            pass
+    
+    async def _misc_loop(self):
+        # Keepalive pings and retries, as loop_forever() would do
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+    
+    def stop(self):
+        """Disconnect from the broker and let run() return"""
+        if self.stopping.is_set():
             return
-        
-        plaintext = plaintext_padded[:-padding_len]
-        
-        print(f"✓ Decryption successful!")
-        print(f"\nDecrypted message:")
-        print(f"  {plaintext.decode('utf-8')}")
-        
-        # Parse JSON
-        try:
-            data = json.loads(plaintext.decode('utf-8'))
-            print(f"\nParsed JSON:")
-            for key, value in data.items():
-                print(f"  {key}: {value}")
-        except json.JSONDecodeError as e:
-            print(f"  (Not valid JSON): {e}")
-        
-        print(f"{'='*60}\n")
-        
-    except Exception as e:
-        print(f"✗ Error processing message: {e}")
-        import traceback
-        traceback.print_exc()
+        self.stopping.set()
+        self.client.disconnect()
+    
+    async def run(self):
+        """Run until stop() is called, reconnecting after unexpected drops"""
+        delay = 1
+        while True:
+            await self.closed.wait()
+            if self.stopping.is_set():
+                return
+            
+            # Back off before reconnecting, but return at once if stop() is
+            # called meanwhile (disconnect() has no socket to close then)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+            
+            try:
+                log.info("Reconnecting to broker...")
+                self.client.reconnect()
+                delay = 1
+            except OSError as e:
+                log.warning("✗ Reconnect failed: %s", e)
+                delay = min(delay * 2, 120)
 
 # ============================================================================
 # Test Functions
@@ -139,40 +457,123 @@ def on_message(client, userdata, msg):
 
 def encrypt_led_command(brightness):
     """Encrypt LED brightness command (for testing)"""
-    import secrets
-    
     plaintext = f'{{"device":"TestClient","brightness":{brightness},"timestamp":{int(time.time())}}}'
     plaintext_bytes = plaintext.encode('utf-8')
     
-    # Generate random IV
-    iv = secrets.token_bytes(16)
+    # Generate random IV (direct getrandom() call, no secrets wrapper)
+    iv = os.urandom(16)
     
     # Apply PKCS#7 padding
     block_size = 16
     padding_len = block_size - (len(plaintext_bytes) % block_size)
-    padded = plaintext_bytes + bytes([padding_len] * padding_len)
+    ciphertext_len = len(plaintext_bytes) + padding_len
     
-    # Encrypt
-    cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
-    ciphertext = cipher.encrypt(padded)
+    # Final payload [IV][Ciphertext][HMAC], built in one preallocated buffer
+    payload = bytearray(16 + ciphertext_len + 32)
+    view = memoryview(payload)
+    view[:16] = iv
+    view[16:16 + len(plaintext_bytes)] = plaintext_bytes
+    view[16 + len(plaintext_bytes):16 + ciphertext_len] = bytes([padding_len]) * padding_len
     
-    # Concatenate IV + ciphertext
-    encrypted_data = iv + ciphertext
+    # Encrypt the padded plaintext in place (one CBC call, no extra buffer)
+    padded = view[16:16 + ciphertext_len]
+    AES.new(AES_KEY, AES.MODE_CBC, iv, use_aesni=True).encrypt(padded, output=padded)
     
-    # Compute HMAC
-    hmac_obj = HMAC.new(HMAC_KEY, msg=encrypted_data, digestmod=SHA256)
-    hmac_value = hmac_obj.digest()
+    # Compute HMAC over IV + ciphertext
+    hmac_obj = _HMAC_TEMPLATE.copy()
+    hmac_obj.update(view[:16 + ciphertext_len])
+    view[16 + ciphertext_len:] = hmac_obj.digest()
     
-    # Final payload
-    payload = encrypted_data + hmac_value
-    
-    print(f"\nEncrypted LED command:")
-    print(f"  Plaintext: {plaintext}")
-    print(f"  Payload length: {len(payload)} bytes")
-    print(f"  (IV: 16B, Ciphertext: {len(ciphertext)}B, HMAC: 32B)")
+    log.debug("Encrypted LED command: %s", plaintext)
+    log.debug("  Payload length: %d bytes (IV: 16B, Ciphertext: %dB, HMAC: 32B)",
+              len(payload), ciphertext_len)
     
     return payload
 
+def watch_stdin(loop, lines):
+    """Feed lines typed on stdin into an asyncio queue ("" at end of input).
+
+    Returns a function that stops watching stdin.
+    """
+    def read_on_thread():
+        # Fallback when the selector cannot watch stdin: console handles on
+        # Windows, or regular files and /dev/null (epoll refuses those)
+        def reader():
+            try:
+                for line in iter(sys.stdin.readline, ""):
+                    loop.call_soon_threadsafe(lines.put_nowait, line)
+                loop.call_soon_threadsafe(lines.put_nowait, "")
+            except RuntimeError:
+                pass  # Event loop already closed
+        
+        threading.Thread(target=reader, name="stdin", daemon=True).start()
+        return lambda: None
+    
+    if sys.platform == "win32":
+        return read_on_thread()
+    
+    # Read the raw fd: a buffered sys.stdin.readline() could keep lines in
+    # its buffer where the selector never sees them
+    fd = sys.stdin.fileno()
+    pending = bytearray()
+    
+    def on_readable():
+        data = os.read(fd, 4096)
+        pending.extend(data)
+        while (end := pending.find(b"\n")) >= 0:
+            lines.put_nowait(pending[:end + 1].decode(errors="replace"))
+            del pending[:end + 1]
+        
+        if not data:
+            loop.remove_reader(fd)
+            lines.put_nowait(pending.decode(errors="replace"))
+            lines.put_nowait("")
+    
+    try:
+        loop.add_reader(fd, on_readable)
+    except (OSError, ValueError):
+        return read_on_thread()
+    return lambda: loop.remove_reader(fd)
+
+async def command_loop(network):
+    """Read brightness values from stdin and publish them as encrypted commands"""
+    # stdin is watched by the same event loop as the MQTT socket, so there
+    # is no blocking input() thread
+    lines = asyncio.Queue()
+    stop_watching = None
+    
+    try:
+        stop_watching = watch_stdin(network.loop, lines)
+        
+        while True:
+            # Optionally publish test commands
+            print("\nEnter brightness (0-255) to send command, or 'q' to quit: ", end="", flush=True)
+            line = await lines.get()
+            if not line:
+                break
+            
+            user_input = line.strip()
+            
+            if user_input.lower() == 'q':
+                break
+            
+            if user_input.isdigit():
+                brightness = int(user_input)
+                if 0 <= brightness <= 255:
+                    payload = encrypt_led_command(brightness)
+                    network.client.publish("led/control/encrypted", payload, qos=1)
+                    print("✓ Command published!")
+                else:
+                    print("✗ Brightness must be 0-255")
+            else:
+                print("✗ Invalid input")
+    
+    finally:
+        if stop_watching is not None:
+            stop_watching()
+        print("\n✓ Shutting down...")
+        network.stop()
+
 # ============================================================================
 # Main
 # ============================================================================
@@ -180,6 +581,8 @@ def encrypt_led_command(brightness):
 def main():
     global MQTT_BROKER, CA_CERT
     
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+    
     # Parse command line arguments
     if len(sys.argv) > 1:
         MQTT_BROKER = sys.argv[1]
@@ -192,6 +595,10 @@ def main():
     print(f"Broker: {MQTT_BROKER}:{MQTT_PORT}")
     print(f"User: {MQTT_USER}")
     print(f"CA Certificate: {CA_CERT}")
+    if AES_NI_AVAILABLE:
+        print("AES backend: AES-NI (hardware)")
+    else:
+        print("⚠ AES backend: software (AES-NI not available, decryption will be slower)")
     print("")
     
     # Check if CA cert exists
@@ -200,8 +607,14 @@ def main():
         print("  Please provide the path to ca.crt from Mosquitto server")
         sys.exit(1)
     
+    # Decrypt received messages off paho's network thread
+    start_decrypt_workers()
+    
     # Create MQTT client
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    # clean_session=False with a fixed client ID keeps the session (and the
+    # subscription) on the broker across reconnects and restarts
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=MQTT_CLIENT_ID,
+                         clean_session=False)
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
@@ -214,6 +627,19 @@ def main():
     # Set credentials
     client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
     
+    # asyncio's default loop on Windows (Proactor) cannot watch sockets
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    
+    try:
+        asyncio.run(run_client(client))
+    except KeyboardInterrupt:
+        print("\n\n✓ Shutting down...")
+
+async def run_client(client):
+    """Connect and serve the client from the asyncio event loop"""
+    network = AsyncioNetworkLoop(asyncio.get_running_loop(), client)
+    
     # Connect
     try:
         print("Connecting to broker...")
@@ -222,39 +648,25 @@ def main():
         print(f"✗ Connection error: {e}")
         sys.exit(1)
     
-    # Start network loop
-    client.loop_start()
+    # Read commands from stdin on the same event loop. However it ends,
+    # the client stops with it, so a failed command loop cannot leave
+    # network.run() waiting forever
+    def commands_done(task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            log.error("✗ Command input failed", exc_info=task.exception())
+        network.stop()
+    
+    commands = asyncio.create_task(command_loop(network))
+    commands.add_done_callback(commands_done)
     
     print("\nClient running. Waiting for messages...")
     print("(Press Ctrl+C to exit)")
     print("")
     
-    try:
-        # Keep program running
-        while True:
-            # Optionally publish test commands
-            user_input = input("\nEnter brightness (0-255) to send command, or 'q' to quit: ").strip()
-            
-            if user_input.lower() == 'q':
-                break
-            
-            if user_input.isdigit():
-                brightness = int(user_input)
-                if 0 <= brightness <= 255:
-                    payload = encrypt_led_command(brightness)
-                    client.publish("led/control/encrypted", payload, qos=1)
-                    print("✓ Command published!")
-                else:
-                    print("✗ Brightness must be 0-255")
-            else:
-                print("✗ Invalid input")
-    
-    except KeyboardInterrupt:
-        print("\n\n✓ Shutting down...")
-    
-    finally:
-        client.loop_stop()
-        client.disconnect()
+    # Returns once command_loop() stops the network loop
+    await network.run()
 
 if __name__ == "__main__":
     main()